@@ -4,5 +4,5 @@ from entitydb.entity import Entity
 from entitydb.entitydb import EntityDB
 
 # Components are actually python dataclasses
-# This line is here for faster importing in other files
-from dataclasses import dataclass as component
+# The decorator also registers them, so they can be found by name when loading
+from entitydb.component import Component, component
@@ -0,0 +1,130 @@
+import dataclasses
+import inspect
+
+
+COMPONENT_REGISTRY: dict[str, type] = dict()
+'''Every component class that has been defined, by name'''
+
+
+def register_component(cls: type) -> type:
+    '''
+    Adds a component class to the registry, so an EntityDB can find it by its name
+    without having seen it being used first. Returns the class.
+    '''
+    # Constructor params are only worked out here for a class with its own `__init__`, as `Component`
+    # subclasses are registered before `dataclasses.dataclass` has given them theirs
+    if "__init__" in cls.__dict__:
+        get_constructor_params(cls)
+    COMPONENT_REGISTRY[cls.__name__] = cls
+    return cls
+
+
+def get_constructor_params(cls: type) -> dict[str, type]:
+    '''
+    Returns the arguments needed to construct a component, and their types.
+    Worked out once per class, then stored on it as `_ctor_params`.
+    Raises TypeError if an argument has no type, as its value couldn't be loaded again.
+    '''
+    # Look in __dict__ so a subclass doesn't use the params of its parent
+    params = cls.__dict__.get("_ctor_params", None)
+    if params is None:
+        spec = inspect.getfullargspec(cls.__init__)
+        params = spec.annotations
+        params.pop("return", None)
+        for name in spec.args[1:] + spec.kwonlyargs:
+            if name not in params:
+                raise TypeError(f"{cls.__name__}.__init__ needs a type annotation for '{name}'")
+        cls._ctor_params = params
+    return params
+
+
+# Values of these types can only change by setting the variable again, which is tracked
+IMMUTABLE_TYPES = (str, int, float, bool, bytes, complex, frozenset, type(None))
+
+
+def track_changes(cls: type) -> type:
+    '''
+    Makes the instances of a class remember which public variables have been set,
+    so saving can skip components that haven't changed. Returns the class.
+    Classes without a `__dict__` (using `__slots__`) or that are frozen are left alone.
+    '''
+    if "__slots__" in cls.__dict__ or getattr(cls, "__setattr__") is not object.__setattr__:
+        return cls
+    cls.__setattr__ = tracked_setattr
+    cls._tracks_changes = True
+    return cls
+
+
+def tracked_setattr(self, name: str, value: object) -> None:
+    object.__setattr__(self, name, value)
+    if not name.startswith("_"):
+        self.__dict__.setdefault("_dirty", set()).add(name)
+
+
+def is_dirty(component: object) -> bool:
+    '''
+    Returns True if the component might have changed since it was last loaded or saved.
+    Always True for components that don't track changes, or that hold mutable values,
+    as those can be changed in place without being set.
+    '''
+    if not getattr(component, "_tracks_changes", False):
+        return True
+    if component.__dict__.get("_dirty", True):
+        return True
+    for varname in get_constructor_params(type(component)):
+        if not isinstance(getattr(component, varname, None), IMMUTABLE_TYPES):
+            return True
+    return False
+
+
+def mark_clean(component: object) -> None:
+    '''Call after a component is loaded or saved'''
+    if getattr(component, "_tracks_changes", False):
+        component.__dict__["_dirty"] = set()
+
+
+def mark_dirty(component: object) -> None:
+    '''Call if a component might not have been saved after all'''
+    if getattr(component, "_tracks_changes", False):
+        component.__dict__["_dirty"] = set(get_constructor_params(type(component)))
+
+
+class Component():
+    '''
+    Optional base class for components.
+    Subclasses register themselves as soon as they are defined, and track their changes.
+    '''
+    _tracks_changes = True
+    __setattr__ = tracked_setattr
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        register_component(cls)
+
+
+def component(cls: type = None, /, **kwargs):
+    '''
+    Turns a class into a component. Works the same as `dataclasses.dataclass`,
+    and takes the same arguments, but also registers the class and tracks its changes.
+    With `slots=True`, a `_uid` slot is added for the database to keep the component's id in.
+    Classes that write their own `__slots__` need to list `_uid` themselves.
+    '''
+    def wrap(cls: type) -> type:
+        if kwargs.get("slots", False):
+            add_uid_field(cls)
+        cls = register_component(track_changes(dataclasses.dataclass(cls, **kwargs)))
+        get_constructor_params(cls)
+        return cls
+
+    if cls is None:
+        return wrap
+    return wrap(cls)
+
+
+def add_uid_field(cls: type) -> None:
+    '''Gives a class about to become a slotted dataclass a field to keep its id in, left out of `__init__`'''
+    annotations = cls.__dict__.get("__annotations__", {})
+    if "_uid" in annotations:
+        return
+    cls.__annotations__ = {**annotations, "_uid": object}
+    cls._uid = dataclasses.field(default=None, init=False, repr=False, compare=False)
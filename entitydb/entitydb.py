@@ -1,9 +1,12 @@
 
-import inspect
+import copy
+import functools
+import weakref
 
 
-from typing import Callable, Type
+from typing import Callable, Iterator, Type
 
+from entitydb.component import COMPONENT_REGISTRY, get_constructor_params, mark_clean
 from entitydb.entity import Entity
 from entitydb.system import SystemCommands, SystemWrapper
 from entitydb.serializers import deserialize
@@ -26,6 +29,11 @@ class EntityDB():
     def __init__(self) -> None:
         self.component_classes: dict[str, type] = dict()
         '''Component classes we have registered'''
+        self._system_cache: weakref.WeakKeyDictionary[Callable, SystemWrapper] = weakref.WeakKeyDictionary()
+        '''
+        System functions we have already parsed. Weak, so systems made on the fly can be freed.
+        The cached wrappers don't hold their function, or it would keep itself alive.
+        '''
 
     def add_entity(self, entity: Entity) -> int:
         '''
@@ -95,10 +103,21 @@ class EntityDB():
         component_name = component.__name__
         if component_name not in self.component_classes:
             self.component_classes[component_name] = component
+            get_constructor_params(component)
             self._setup_component_type(component)
             return True
         return False
 
+    def _get_component_class(self, component_name: str) -> type:
+        '''
+        Finds a component class by name, from the ones registered with this EntityDB
+        or the ones defined with `@component`. Returns None if it can't be found.
+        '''
+        component = self.component_classes.get(component_name, None)
+        if component is None:
+            component = COMPONENT_REGISTRY.get(component_name, None)
+        return component
+
     def _setup_component_type(self, component: type) -> None:
         '''
         Called when a new component is registered. Only called once for each
@@ -121,12 +140,10 @@ class EntityDB():
 
         '''
         index = 0
-        for eid in entity_components:
-            # TODO optimization: read below
-            # Don't bother trying to load every component from DB this entity has,
-            # just load the ones that this function calls for
-            entity: Entity = self._load_entity_from_cids(
-                eid, entity_components[eid])
+        # TODO optimization: read below
+        # Don't bother trying to load every component from DB this entity has,
+        # just load the ones that this function calls for
+        for entity in self._load_entities(entity_components):
             commands = system.run(entity, index)
 
             # * Run the commands
@@ -142,13 +159,21 @@ class EntityDB():
 
             index += 1
 
+    def _load_entities(self, entity_components: dict[str, any]) -> Iterator[Entity]:
+        '''
+        Loads each entity in entity_components (same format as in _run_on_entities), in order.
+        Override this if the storage can load entities ahead of when they are needed.
+        '''
+        for eid in entity_components:
+            yield self._load_entity_from_cids(eid, entity_components[eid])
+
     def _create_component_from_data(self, component_type: type, component_data: dict[str, any], cid:any = None) -> object:
-        component_vars = self.get_instance_variables(component_type)
-        component_values: dict = {}
-        for varname in component_vars:
-            component_values[varname] = deserialize(component_data.get(varname, None), component_vars[varname])
-        result = component_type(**component_values)
+        # Only pass in the data the constructor asks for
+        component_vars = get_constructor_params(component_type)
+        result = component_type(**{varname: deserialize(component_data[varname], component_vars[varname])
+                                   for varname in component_vars if varname in component_data})
         result._uid = cid
+        mark_clean(result)
         return result
 
     def _load_entity_from_cids(self, eid: str, components: dict[str, any]) -> Entity:
@@ -160,20 +185,50 @@ class EntityDB():
     def _parse_system(self, system_func:Callable) -> SystemWrapper:
         '''
         Analises the passed in system, putting it in a wrapper to easily access
-        its properties.
+        its properties. The wrapper is cached, so each system is only analysed once.
         '''
-        result = SystemWrapper(self, system_func)
-        # Might be some components in the call signature we haven't seen yet
-        for component_type in result.get_components_from_signature():
-            self._register_component_type(component_type)
+        try:
+            cached = self._system_cache.get(system_func, None)
+        except TypeError:
+            # Can't be weakly referenced, so it can't be cached either
+            cached = None
+
+        if cached is None:
+            result = SystemWrapper(self, system_func)
+            # Might be some components in the call signature we haven't seen yet
+            for component_type in result.get_components_from_signature():
+                self._register_component_type(component_type)
+            self._setup_system(result)
+            cached = copy.copy(result)
+            cached.system = None
+            try:
+                self._system_cache[system_func] = cached
+            except TypeError:
+                pass
+            return result
+
+        result = copy.copy(cached)
+        result.system = system_func
         return result
 
+    def _setup_system(self, system: SystemWrapper) -> None:
+        '''
+        Called the first time a system is parsed. Only called once for each system function.
+
+        Use this as an opportunity to prepare anything needed to query for this system.
+        '''
+        pass
+
     @classmethod
     def get_variables_of(cls, o: object) -> dict[str, object]:
         '''
         Returns the public variables of this object.
         Result is a dict of the var name, to its value
         '''
+        # Objects using __slots__ already list their variables, no need to search dir()
+        if not hasattr(o, "__dict__"):
+            return {var_name: getattr(o, var_name) for var_name in get_slot_names(type(o))}
+
         result = dict()
 
         var_names = dir(o)
@@ -184,11 +239,18 @@ class EntityDB():
 
         return result
 
-    @classmethod
-    def get_instance_variables(cls, t: Type) -> dict[str, Type]:
-        '''
-        Given a type (class), will return the arguments needed to construct it
-        '''
-        args = inspect.getfullargspec(t.__init__).annotations
-        args.pop("return", None)
-        return args
+
+@functools.lru_cache(maxsize=None)
+def get_slot_names(t: Type) -> tuple[str, ...]:
+    '''
+    Returns the public names in `__slots__` of this class and its parents
+    '''
+    result = []
+    for cls in t.__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if not name.startswith("_") and name not in result:
+                result.append(name)
+    return tuple(result)
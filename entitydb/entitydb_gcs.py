@@ -1,16 +1,31 @@
-import random
+import atexit
+import collections
+import concurrent.futures
+import inspect
+import re
+import secrets
 import sys
 import string
-from typing import Callable, Type, final
+import threading
+import time
+import weakref
+from typing import Callable, Iterable, Iterator, Type, final
 from entitydb.entitydb import EntityDB, PRIMARY_KEY, ENTITY_REFERENCE, ENTITY_TABLE
+from entitydb.component import get_constructor_params, is_dirty, mark_clean, mark_dirty
 from entitydb.entity import Entity
 from entitydb.system import SystemWrapper, SystemCommands
 
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
 from google.cloud.storage import Bucket, Blob
 import google.api_core.exceptions as google_exceptions
+import msgpack
+import numpy as np
 from oauth2client.service_account import ServiceAccountCredentials
 from entitydb.serializers import serialize
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 
 REGION = "AUSTRALIA-SOUTHEAST1"
@@ -18,14 +33,86 @@ BLOBNAME_DELIMITER = "/"
 ENTITY_FOLDER = "ent"
 COMPONENT_FOLDER = "cmp"
 DATA_FOLDER = "dat"
+COMPONENT_MIME_TYPE = "application/x-msgpack"
 UID_LENGTH = 16
+IO_POOL_SIZE = 32
+HTTP_POOL_SIZE = 64
+HTTP_RETRIES = 5
+PREFETCH_DEPTH = 16
+BLOB_CACHE_SIZE = 10000
+INDEX_TTL = 5.0
+
+# Matches index blob names, "cmp/{component_name}/{eid}-{cid}", one per line
+INDEX_BLOB_NAME_RE = re.compile(
+    rf"^{COMPONENT_FOLDER}{BLOBNAME_DELIMITER}([^/]+){BLOBNAME_DELIMITER}([^/-]+)-([^/-]+)$", re.MULTILINE)
+
+# Listing several folders with one glob needs a recent google-cloud-storage
+LIST_SUPPORTS_MATCH_GLOB = "match_glob" in inspect.signature(storage.Client.list_blobs).parameters
 
 
 class EntityDB_GCS(EntityDB):
-    def __init__(self, bucket_name: str) -> None:
-        self.storage_client = storage.Client()
+    def __init__(self, bucket_name: str, index_ttl: float = INDEX_TTL, cache_components: bool = False,
+                 http_pool_size: int = HTTP_POOL_SIZE) -> None:
+        '''
+        `index_ttl` is how many seconds a listing of a component's entities is trusted for,
+        before the bucket is listed again to pick up changes made by other clients.
+
+        `cache_components` keeps every component this client loads or saves in memory, and hands
+        out those same objects instead of downloading them again. Off by default, as:
+        - Systems get the cached objects themselves, so changes made without returning
+          `SAVE_ENTITY` are still seen by later systems, even though they were never saved.
+        - Saves are written in the background. Call `flush()` to wait for them and see any errors,
+          otherwise errors are raised by the next `update_entity`, or when the program exits.
+        - The cache is never trimmed, and changes made by other clients aren't seen while
+          a component is cached.
+
+        `http_pool_size` is how many connections to GCS are kept open and reused. Keep it at least
+        as big as IO_POOL_SIZE, or the worker threads will wait on each other for a connection.
+        '''
+        # Share one keep-alive HTTP session between all threads, with enough pooled
+        # connections that requests don't pay for a new TLS handshake each time
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        session.mount("https://", HTTPAdapter(
+            pool_maxsize=http_pool_size,
+            max_retries=Retry(total=HTTP_RETRIES, backoff_factor=0.1)))
+        self.storage_client = storage.Client(project=project, _http=session)
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IO_POOL_SIZE)
         self.bucket = self._init_bucket(bucket_name)
 
+        self.index_ttl = index_ttl
+        self._component_index: dict[str, dict[str, str]] = {}
+        '''Cached listings of each component folder, component name to {eid: cid}'''
+        self._component_index_times: dict[str, float] = {}
+        self._dirty_components: set[str] = set()
+        '''Component names whose cached listing can't be trusted and must be listed again'''
+
+        # Every eid we have seen gets a bit index, so a component's listing can also be
+        # kept as a bitset and queries become AND/AND-NOTs over whole words
+        self._eid_to_ix: dict[str, int] = {}
+        self._ix_to_eid: list[str] = []
+        '''None where the index has been freed'''
+        self._free_ixs: list[int] = []
+        '''Indices of deleted entities, given out again before the bitsets are grown'''
+        self._bitset_words: int = 1
+        self._component_bitsets: dict[str, np.ndarray] = {}
+        '''Component name to a uint64 bitset of the entities that have it'''
+
+        self.cache_components = cache_components
+        self._components_by_type: dict[type, dict[str, object]] = collections.defaultdict(dict)
+        '''Live component objects, by their type then eid'''
+        self._pending_writes: dict[str, concurrent.futures.Future] = {}
+        '''Component uploads still running in the background, by cid'''
+        if cache_components:
+            # Background saves that fail after the last flush would otherwise never be reported
+            atexit.register(flush_at_exit, weakref.ref(self))
+
+        self._packers = threading.local()
+
+        self._blob_cache: collections.OrderedDict[str, tuple[int, bytes]] = collections.OrderedDict()
+        '''The last known generation and body of component blobs, least recently used first'''
+        self._blob_cache_lock = threading.Lock()
+
         # Add a new object
         # blob = self.bucket.blob("empty_file")
         # blob.upload_from_string("")
@@ -41,88 +128,177 @@ class EntityDB_GCS(EntityDB):
         entity.uid = new_eid
         entity.db = self
 
-        component_uids = []
+        # Map of component names to cids, stored in the entity's manifest
+        component_uids: dict[str, str] = {}
+
+        # Names of the index blobs, and the serialized components to upload
+        index_blobs: list[str] = []
+        data_blobs: list[tuple[str, bytes]] = []
 
         # * Add each component
         for component in entity.get_components():
-            self._register_component_type(type(component))
-            component_name = type(component).__name__
-            component._uid = self._random_cid()
-            component_uids.append(component._uid)
-            # Map of entities to components
-            self._create_empty_blob(
-                f"{ENTITY_FOLDER}/{entity.uid}/{component_name}-{component._uid}")
+            component_type = type(component)
+            component_name = component_type.__name__
+            cid = self._random_cid()
+            component._uid = cid
+            component_uids[component_name] = cid
             # Map of components to entities
-            self._create_empty_blob(
-                f"{COMPONENT_FOLDER}/{component_name}/{entity.uid}-{component._uid}")
+            index_blobs.append(
+                f"{COMPONENT_FOLDER}/{component_name}/{new_eid}-{cid}")
+
+            # Actual data, components without any fields don't need a blob
+            if get_constructor_params(component_type):
+                data_blobs.append((cid, self._pack_component(component)))
+
+        # * Upload everything for this entity at the same time
+        futures = [self._io_pool.submit(self._create_empty_blob, name)
+                   for name in index_blobs]
+        # Map of entities to components, one blob for the whole entity
+        futures.append(self._io_pool.submit(
+            self._upload_manifest_blob, new_eid, component_uids))
+        for cid, body in data_blobs:
+            futures.append(self._io_pool.submit(
+                self._upload_component_blob, cid, body))
+        try:
+            self._wait_for(futures)
+        except Exception:
+            # Unsure which blobs made it, so let the next query list them itself
+            self._dirty_components.update(component_uids)
+            raise
 
-            # Actual data
-            vars = EntityDB.get_variables_of(component)
-            for varname in vars:
-                self._create_data_blob(component._uid, varname, vars[varname])
+        for component in entity.get_components():
+            mark_clean(component)
+            if self.cache_components:
+                self._components_by_type[type(component)][new_eid] = component
+
+        ix = None
+        for component_name in component_uids:
+            if component_name in self._component_index:
+                if ix is None:
+                    ix = self._get_entity_ix(new_eid)
+                self._component_index[component_name][new_eid] = component_uids[component_name]
+                set_bit(self._component_bitsets[component_name], ix)
 
         return new_eid
 
     def update_entity(self, entity: Entity) -> bool:
-        for component in entity.get_components():
-            vars = EntityDB.get_variables_of(component)
-            for varname in vars:
-                self._create_data_blob(component._uid, varname, vars[varname])
+        # Only save the components that have changed, and that have fields to save
+        changed_components = [component for component in entity.get_components()
+                              if is_dirty(component) and get_constructor_params(type(component))]
+        if self.cache_components:
+            # Don't let a failed background save go unnoticed.
+            # Raised before anything is marked clean, so retrying saves the components again
+            self._raise_failed_writes()
+
+        data_blobs = [(component._uid, self._pack_component(component)) for component in changed_components]
+        # Anything changed from here on is after what is being saved
+        for component in changed_components:
+            mark_clean(component)
+
+        if not self.cache_components:
+            futures = [self._io_pool.submit(self._upload_component_blob, cid, body)
+                       for cid, body in data_blobs]
+            try:
+                self._wait_for(futures)
+            except Exception:
+                for component in changed_components:
+                    mark_dirty(component)
+                raise
+            return True
+
+        # The cache is already up to date, so the uploads can finish in the background
+        for component in changed_components:
+            self._components_by_type[type(component)][entity.uid] = component
+        for component, (cid, body) in zip(changed_components, data_blobs):
+            self._write_behind(entity.uid, component, body)
+        return True
+
+    def flush(self) -> None:
+        '''
+        Waits for every background save to finish.
+        Raises the first error if any of them failed.
+        '''
+        concurrent.futures.wait(list(self._pending_writes.values()))
+        self._raise_failed_writes()
 
     def delete_entity(self, entity: Entity) -> None:
-        if not entity.uid:
+        if not getattr(entity, "uid", None):
             raise Exception("Entity has not been saved yet")
-        super().delete_entity(entity)
+
+        # The manifest knows every component, including ones that aren't loaded
+        components = self._load_manifest(entity.uid)
+        blob_names: list[str] = [f"{ENTITY_FOLDER}/{entity.uid}"]
+        for component_name in components:
+            cid = components[component_name]
+            # Don't let a background save bring the data back after it is deleted
+            # (a worker thread may drop it from _pending_writes at any time)
+            pending = self._pending_writes.get(cid, None)
+            if pending is not None:
+                pending.exception()
+            component_type = self._get_component_class(component_name)
+            if component_type:
+                self._components_by_type[component_type].pop(entity.uid, None)
+            blob_names.append(f"{COMPONENT_FOLDER}/{component_name}/{entity.uid}-{cid}")
+            if component_type is None or get_constructor_params(component_type):
+                blob_names.append(f"{DATA_FOLDER}/{cid}")
+
+        futures = [self._io_pool.submit(self._delete_blob, name)
+                   for name in blob_names]
+        try:
+            self._wait_for(futures)
+        except Exception:
+            self._dirty_components.update(components)
+            raise
+
+        for component_name in components:
+            if component_name in self._component_index:
+                self._component_index[component_name].pop(entity.uid, None)
+        self._free_entity_ix(entity.uid)
 
     def run(self, system_func: Callable) -> None:
         system = self._parse_system(system_func)
 
         # * Find all components matching in the query
-
-        # A set of entity IDs that match the query
-        matched_eids: set = None
-
-        # All found eids, and their dict of component names to cids (only components that exist in the query)
-        all_entities: dict[str, dict[str, str]] = dict()
-
-        for var_name in system.include_components:
-            component_name = system.include_components[var_name].__name__
-            blobs = self._search_blobs(f"{COMPONENT_FOLDER}/{component_name}/")
-            found_components: set[str] = set()
-            for blob in blobs:
-                eid, cid = blob.name.split(BLOBNAME_DELIMITER)[-1].split("-")
-                found_components.add(eid)
-                if eid in all_entities:
-                    all_entities[eid][component_name] = cid
-                else:
-                    all_entities[eid] = {component_name: cid}
-
-            if matched_eids:
-                matched_eids = matched_eids & found_components
-            else:
-                matched_eids = found_components
-
-        # TODO search the ENTITIES_FOLDER instead
-        for component in system.exclude_components:
-            blobs = self._search_blobs(f"{COMPONENT_FOLDER}/{component.__name__}/")
-            exclude_eids: set[str] = set()
-            for blob in blobs:
-                eid, cid = blob.name.split(BLOBNAME_DELIMITER)[-1].split("-")
-                exclude_eids.add(eid)
-            matched_eids -= exclude_eids
+        matched_ixs = self._match_entities(system)
 
         # TODO optional components
 
         # * Load the components of the matched eids
+        # Component name to {eid: cid}, for the components in the query
+        found_components: dict[str, dict[str, str]] = dict()
+        for component_name in system.include_names:
+            found_components[component_name] = self._component_index[component_name]
+
         matched_entities: dict[str, dict[str, str]] = dict()
 
-        for eid in matched_eids:
-            matched_entities[eid] = all_entities[eid]
+        for ix in matched_ixs:
+            eid = self._ix_to_eid[ix]
+            matched_entities[eid] = {component_name: found_components[component_name][eid]
+                                     for component_name in found_components}
 
         self._run_on_entities(system, matched_entities)
 
     def count_matches(self, system_func: Callable) -> int:
-        return super().count_matches(system_func)
+        return len(self._match_entities(self._parse_system(system_func)))
+
+    def load_component(self, entity: Entity, component_type: type) -> bool:
+        self._register_component_type(component_type)
+        component_name = component_type.__name__
+
+        cid = self._load_manifest(entity.uid).get(component_name, None)
+        if not cid:
+            return False
+
+        component = self._get_cached_component(component_type, entity.uid, cid)
+        if component is None:
+            component = self._load_component_from_cid(component_type, cid)
+            if self.cache_components:
+                self._components_by_type[component_type][entity.uid] = component
+        entity._components[component_type] = component
+        if component_name in entity._unloaded_components:  # Clean up
+            entity._unloaded_components.remove(component_name)
+
+        return True
 
     def _init_bucket(self, bucket_name: str):
         '''Ensures the bucket exists, creates it if it doesn't'''
@@ -146,28 +322,116 @@ class EntityDB_GCS(EntityDB):
             result.append(bucket)
         return result
     
-    def _create_data_blob(self, cid: str, varname: str, data: object) -> Blob:
-        '''Creates a blob that stores a field in a component'''
-        new_blob = self.bucket.blob(f"{DATA_FOLDER}/{cid}/{varname}")
-        final_data, mime_type = serialize(data)     
-        new_blob.content_type = mime_type
-        new_blob.upload_from_string(final_data, content_type=mime_type)
+    def _pack_component(self, component: object) -> bytes:
+        '''Serializes every field of a component into a single blob body'''
+        vars = EntityDB.get_variables_of(component)
+        return self._get_packer().pack({varname: serialize(vars[varname])[0] for varname in vars})
+
+    def _get_packer(self) -> msgpack.Packer:
+        '''Gets this thread's packer, so its buffer is reused instead of making a new one each time'''
+        packer = getattr(self._packers, "packer", None)
+        if packer is None:
+            packer = msgpack.Packer(use_bin_type=True)
+            self._packers.packer = packer
+        return packer
+
+    def _upload_component_blob(self, cid: str, body: bytes) -> Blob:
+        '''Uploads an already serialized component'''
+        new_blob = self.bucket.blob(f"{DATA_FOLDER}/{cid}")
+        new_blob.content_type = COMPONENT_MIME_TYPE
+        # Whatever happens, the cached body is out of date now
+        self._forget_blob(new_blob.name)
+        new_blob.upload_from_string(body, content_type=COMPONENT_MIME_TYPE)
+        self._remember_blob(new_blob.name, new_blob.generation, body)
+        return new_blob
+
+    def _upload_manifest_blob(self, eid: str, components: dict[str, str]) -> Blob:
+        '''Uploads the manifest of an entity, a map of its component names to cids'''
+        new_blob = self.bucket.blob(f"{ENTITY_FOLDER}/{eid}")
+        body = self._get_packer().pack(components)
+        new_blob.upload_from_string(body, content_type=COMPONENT_MIME_TYPE)
         return new_blob
 
+    def _load_manifest(self, eid: str) -> dict[str, str]:
+        '''Gets the component names and cids of an entity. Empty if the entity doesn't exist'''
+        try:
+            return msgpack.unpackb(self.bucket.blob(f"{ENTITY_FOLDER}/{eid}").download_as_bytes(), raw=False)
+        except google_exceptions.NotFound:
+            return {}
+
     def _create_empty_blob(self, name: str) -> Blob:
         return self.bucket.blob(name).upload_from_string("")
 
+    def _delete_blob(self, name: str) -> None:
+        '''Deletes a blob, doesn't mind if it is already gone'''
+        self._forget_blob(name)
+        try:
+            self.bucket.blob(name).delete()
+        except google_exceptions.NotFound:
+            pass
+
+    def _raise_failed_writes(self) -> None:
+        '''Forgets the background saves that have finished, raising the first error if any failed'''
+        failed: list[concurrent.futures.Future] = []
+        for cid in list(self._pending_writes):
+            # Worker threads drop successful saves themselves, so it may be gone already
+            future = self._pending_writes.get(cid, None)
+            if future is None or not future.done():
+                continue
+            if self._pending_writes.get(cid, None) is future:
+                self._pending_writes.pop(cid, None)
+            if future.exception():
+                failed.append(future)
+        if failed:
+            failed[0].result()
+
+    def _write_behind(self, eid: str, component: object, body: bytes) -> None:
+        '''Uploads a component in the background, after any earlier upload of it'''
+        cid = component._uid
+        previous = self._pending_writes.get(cid, None)
+
+        def write() -> None:
+            if previous:
+                # Submitted earlier, so it is already running or next in the queue
+                previous.exception()
+            self._upload_component_blob(cid, body)
+
+        future = self._io_pool.submit(write)
+        self._pending_writes[cid] = future
+
+        def done(future: concurrent.futures.Future) -> None:
+            if future.exception():
+                # Storage doesn't have what the cache does anymore, so forget it
+                # and make sure the next save sends it again
+                mark_dirty(component)
+                components = self._components_by_type[type(component)]
+                if components.get(eid, None) is component:
+                    components.pop(eid, None)
+            elif self._pending_writes.get(cid, None) is future:
+                self._pending_writes.pop(cid, None)
+
+        future.add_done_callback(done)
+
+    def _wait_for(self, futures: list[concurrent.futures.Future]) -> None:
+        '''Blocks until every future is done, re-raising the first error if any failed'''
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
     def _random_id(self, length: int) -> str:
-        '''Create a new random ID'''
-        return "".join(random.choice(string.ascii_letters + string.digits) for i in range(length))
+        '''
+        Create a new random ID.
+        Hex only, as '-' and '/' are used as separators in blob names
+        '''
+        return secrets.token_hex((length + 1) // 2)[:length]
 
     def _random_eid(self) -> str:
         '''Create a new random ID for use in entities. First char will always be a number'''
-        return random.choice(string.digits) + self._random_id(UID_LENGTH - 1)
+        return secrets.choice(string.digits) + self._random_id(UID_LENGTH - 1)
 
     def _random_cid(self) -> str:
         '''Create a new random ID for use in components. First char will always be a letter'''
-        return random.choice(string.ascii_letters) + self._random_id(UID_LENGTH - 1)
+        return secrets.choice(string.ascii_letters) + self._random_id(UID_LENGTH - 1)
 
     def _search_blobs(self, prefix: str):
         '''
@@ -177,19 +441,298 @@ class EntityDB_GCS(EntityDB):
         '''
         return self.storage_client.list_blobs(self.bucket, prefix=prefix, delimiter=BLOBNAME_DELIMITER)
 
+    def _setup_system(self, system: SystemWrapper) -> None:
+        system.include_names = tuple(system.include_components[var_name].__name__
+                                     for var_name in system.include_components)
+        system.exclude_names = tuple(component.__name__ for component in system.exclude_components)
+        system.matcher = self._compile_matcher(system)
+
+    def _compile_matcher(self, system: SystemWrapper) -> Callable[[dict[str, np.ndarray]], np.ndarray]:
+        '''
+        Creates a function for this system's query, which takes the component bitsets
+        and returns the bit indices of the matching entities.
+        '''
+        include_names = system.include_names
+        exclude_names = system.exclude_names
+
+        # Nothing matches a query without any required components
+        if not include_names:
+            return lambda component_bitsets: np.zeros(0, dtype=np.intp)
+
+        first_name = include_names[0]
+        other_names = include_names[1:]
+
+        def matcher(component_bitsets: dict[str, np.ndarray]) -> np.ndarray:
+            mask = component_bitsets[first_name].copy()
+            for component_name in other_names:
+                mask &= component_bitsets[component_name]
+            if not mask.any():
+                return np.zeros(0, dtype=np.intp)
+            for component_name in exclude_names:
+                mask &= ~component_bitsets[component_name]
+            return bitset_indices(mask)
+
+        return matcher
+
+    def _match_entities(self, system: SystemWrapper) -> np.ndarray:
+        '''Returns the bit indices of the entities that match the system'''
+        include_names = system.include_names
+
+        # Intersect the components that don't need listing first, smallest first.
+        # If nothing is left the other components never have to be listed at all
+        fresh_names = sorted((name for name in include_names if not self._is_component_index_stale(name)),
+                             key=lambda name: len(self._component_index[name]))
+        if fresh_names and len(fresh_names) < len(include_names):
+            mask = self._component_bitsets[fresh_names[0]].copy()
+            for component_name in fresh_names[1:]:
+                if not mask.any():
+                    break
+                mask &= self._component_bitsets[component_name]
+            if not mask.any():
+                return np.zeros(0, dtype=np.intp)
+
+        # Make sure the listing of every component in the query is fresh
+        self._refresh_component_indexes(include_names + system.exclude_names)
+        return system.matcher(self._component_bitsets)
+
+    def _get_component_index(self, component_name: str) -> dict[str, str]:
+        '''
+        Gets a dict of eid to cid for every entity that has this component.
+        Uses the cached listing unless it is dirty or older than `index_ttl`.
+        '''
+        self._refresh_component_indexes([component_name])
+        return self._component_index[component_name]
+
+    def _is_component_index_stale(self, component_name: str) -> bool:
+        listed_at = self._component_index_times.get(component_name, None)
+        return listed_at is None or component_name in self._dirty_components or \
+            time.monotonic() - listed_at > self.index_ttl
+
+    def _refresh_component_indexes(self, component_names: Iterable[str]) -> None:
+        '''
+        Lists the folders of the given components again, if their cached listing is stale.
+        All of the stale components are listed together, in a single glob request if
+        the storage library supports it, otherwise one listing each at the same time.
+        '''
+        stale_names = [name for name in dict.fromkeys(component_names)
+                       if self._is_component_index_stale(name)]
+        if not stale_names:
+            return
+
+        component_indexes: dict[str, dict[str, str]] = {name: {} for name in stale_names}
+        if len(stale_names) == 1:
+            blobs = self._search_blobs(f"{COMPONENT_FOLDER}/{stale_names[0]}/")
+        elif LIST_SUPPORTS_MATCH_GLOB:
+            # The prefix keeps the server from scanning the data and entity folders too
+            blobs = self.storage_client.list_blobs(
+                self.bucket, prefix=f"{COMPONENT_FOLDER}{BLOBNAME_DELIMITER}",
+                match_glob=f"{COMPONENT_FOLDER}/{{{','.join(stale_names)}}}/*")
+        else:
+            # The listings are lazy, so the requests are made by list() inside the pool
+            futures = [self._io_pool.submit(list, self._search_blobs(f"{COMPONENT_FOLDER}/{name}/"))
+                       for name in stale_names]
+            self._wait_for(futures)
+            blobs = [blob for future in futures for blob in future.result()]
+
+        # Parse every name in one go, rather than splitting each of them up
+        for component_name, eid, cid in INDEX_BLOB_NAME_RE.findall("\n".join(blob.name for blob in blobs)):
+            component_indexes[component_name][eid] = cid
+
+        listed_at = time.monotonic()
+        removed_eids: set[str] = set()
+        for component_name in component_indexes:
+            component_index = component_indexes[component_name]
+            removed_eids.update(self._component_index.get(component_name, {}).keys() - component_index.keys())
+            ixs = [self._get_entity_ix(eid) for eid in component_index]
+            bitset = np.zeros(self._bitset_words, dtype=np.uint64)
+            for ix in ixs:
+                set_bit(bitset, ix)
+            self._component_index[component_name] = component_index
+            self._component_bitsets[component_name] = bitset
+            self._component_index_times[component_name] = listed_at
+            self._dirty_components.discard(component_name)
+
+        # Entities deleted by other clients, their indices can be reused once no listing has them
+        for eid in removed_eids:
+            ix = self._eid_to_ix.get(eid, None)
+            if ix is not None and not any(get_bit(bitset, ix) for bitset in self._component_bitsets.values()):
+                self._free_entity_ix(eid)
+
+    def _get_entity_ix(self, eid: str) -> int:
+        '''Gets the bit index of an entity, giving it a free one if it is new'''
+        ix = self._eid_to_ix.get(eid, None)
+        if ix is None and self._free_ixs:
+            ix = self._free_ixs.pop()
+            self._eid_to_ix[eid] = ix
+            self._ix_to_eid[ix] = eid
+        elif ix is None:
+            ix = len(self._ix_to_eid)
+            self._eid_to_ix[eid] = ix
+            self._ix_to_eid.append(eid)
+            if ix >= self._bitset_words * 64:
+                # Out of room, double the size of every bitset
+                padding = np.zeros(self._bitset_words, dtype=np.uint64)
+                self._bitset_words *= 2
+                for component_name in self._component_bitsets:
+                    self._component_bitsets[component_name] = np.concatenate(
+                        (self._component_bitsets[component_name], padding))
+        return ix
+
+    def _free_entity_ix(self, eid: str) -> None:
+        '''Clears the bits of an entity that is gone, and lets its index be given out again'''
+        ix = self._eid_to_ix.pop(eid, None)
+        if ix is None:
+            return
+        for bitset in self._component_bitsets.values():
+            clear_bit(bitset, ix)
+        self._ix_to_eid[ix] = None
+        self._free_ixs.append(ix)
+
     def _load_entity_from_cids(self, eid: str, components: dict[str, str]) -> Entity:
-        result = Entity([])
-        result.uid = eid
+        return self._create_entity_from_downloads(eid, self._start_downloads(eid, components))
+
+    def _load_entities(self, entity_components: dict[str, dict[str, str]]) -> Iterator[Entity]:
+        '''
+        Keeps up to PREFETCH_DEPTH entities downloading in the background,
+        while the caller works on the ones that have already been yielded.
+        '''
+        pending: collections.deque[tuple[str, dict]] = collections.deque()
+        try:
+            for eid in entity_components:
+                pending.append((eid, self._start_downloads(eid, entity_components[eid])))
+                if len(pending) > PREFETCH_DEPTH:
+                    entity = self._create_entity_from_downloads(*pending.popleft())
+                    if entity is not None:
+                        yield entity
+            while pending:
+                entity = self._create_entity_from_downloads(*pending.popleft())
+                if entity is not None:
+                    yield entity
+        finally:
+            # Stopped early, don't bother downloading the rest
+            for eid, downloads in pending:
+                for cid, download in downloads.values():
+                    if isinstance(download, concurrent.futures.Future):
+                        download.cancel()
+
+    def _start_downloads(self, eid: str, components: dict[str, str]) -> dict[str, tuple[str, object]]:
+        '''
+        Starts downloading the data of each component at the same time.
+        Returns a dict of the component names to their cid and either the download future,
+        or the component itself if it was cached.
+        '''
+        result: dict[str, tuple[str, object]] = {}
         for comp_name in components:
             cid = components[comp_name]
-            component_data: dict = dict()
-            blobs: list[Blob] = self._search_blobs(f"{DATA_FOLDER}/{cid}/")
-            # Iterate over every property in the blob
-            for blob in blobs:
-                varname = blob.name.split("/")[-1]
-                component_data[varname] = blob.download_as_bytes()
-            # Need to get the component name somehow, might need to rethink how the data is stored
-            component_type = self.component_classes[comp_name]
-            new_component = self._create_component_from_data(component_type, component_data, cid)
-            result._components[component_type] = new_component
+            component_type = self._get_component_class(comp_name)
+            component = self._get_cached_component(component_type, eid, cid)
+            if component is None:
+                if get_constructor_params(component_type):
+                    component = self._io_pool.submit(self._download_component_blob, cid)
+                else:
+                    # Nothing stored for this component, as it has no fields
+                    component = self._create_component_from_data(component_type, {}, cid)
+            result[comp_name] = (cid, component)
+        return result
+
+    def _create_entity_from_downloads(self, eid: str, downloads: dict[str, tuple[str, object]]) -> Entity:
+        '''
+        Waits for the downloads from _start_downloads, and creates the entity from them.
+        Returns None if the entity has been deleted since its components were listed.
+        '''
+        result = Entity([])
+        result.uid = eid
+        for comp_name in downloads:
+            cid, download = downloads[comp_name]
+            component_type = self._get_component_class(comp_name)
+            if isinstance(download, concurrent.futures.Future):
+                try:
+                    body = download.result()
+                except google_exceptions.NotFound:
+                    # Another client deleted it, so the cached listings are out of date
+                    self._dirty_components.update(downloads)
+                    return None
+                download = self._create_component_from_data(
+                    component_type, msgpack.unpackb(body, raw=False), cid)
+                if self.cache_components:
+                    self._components_by_type[component_type][eid] = download
+            result._components[component_type] = download
         return result
+
+    def _get_cached_component(self, component_type: type, eid: str, cid: str) -> object:
+        '''Gets the live component from the cache, or None if it isn't cached'''
+        component = self._components_by_type[component_type].get(eid, None)
+        if component is not None and component._uid == cid:
+            return component
+        return None
+
+    def _load_component_from_cid(self, component_type: type, cid: str) -> object:
+        component_data: dict = {}
+        if get_constructor_params(component_type):
+            component_data = msgpack.unpackb(self._download_component_blob(cid), raw=False)
+        return self._create_component_from_data(component_type, component_data, cid)
+
+    def _download_component_blob(self, cid: str) -> bytes:
+        # Every property of the component is stored in the one blob.
+        # Its name is known from the cid, so there is no need to list anything
+        blob = self.bucket.blob(f"{DATA_FOLDER}/{cid}")
+        with self._blob_cache_lock:
+            cached = self._blob_cache.get(blob.name, None)
+            if cached:
+                self._blob_cache.move_to_end(blob.name)
+
+        try:
+            if cached is None:
+                body = blob.download_as_bytes()
+            else:
+                # Only sends the body back if it changed since we last saw it
+                generation, body = cached
+                body = blob.download_as_bytes(if_generation_not_match=generation)
+        except google_exceptions.NotModified:
+            return body
+        except google_exceptions.NotFound:
+            self._forget_blob(blob.name)
+            raise
+
+        self._remember_blob(blob.name, blob.generation, body)
+        return body
+
+    def _remember_blob(self, name: str, generation: int, body: bytes) -> None:
+        '''Caches the body of a blob, as of the given generation'''
+        if generation is None:
+            return
+        with self._blob_cache_lock:
+            self._blob_cache[name] = (generation, body)
+            self._blob_cache.move_to_end(name)
+            while len(self._blob_cache) > BLOB_CACHE_SIZE:
+                self._blob_cache.popitem(last=False)
+
+    def _forget_blob(self, name: str) -> None:
+        with self._blob_cache_lock:
+            self._blob_cache.pop(name, None)
+
+
+def flush_at_exit(edb_ref: weakref.ref) -> None:
+    edb = edb_ref()
+    if edb is not None:
+        edb.flush()
+
+
+def set_bit(bitset: np.ndarray, ix: int) -> None:
+    bitset[ix >> 6] |= np.uint64(1 << (ix & 63))
+
+
+def clear_bit(bitset: np.ndarray, ix: int) -> None:
+    bitset[ix >> 6] &= ~np.uint64(1 << (ix & 63))
+
+
+def get_bit(bitset: np.ndarray, ix: int) -> bool:
+    return bool(bitset[ix >> 6] & np.uint64(1 << (ix & 63)))
+
+
+def bitset_indices(bitset: np.ndarray) -> np.ndarray:
+    '''
+    Returns the indices of every set bit, in ascending order.
+    Bit `ix` lives in word `ix >> 6` at position `ix & 63`
+    '''
+    return np.flatnonzero(np.unpackbits(bitset.astype("<u8", copy=False).view(np.uint8), bitorder="little"))
@@ -4,6 +4,7 @@ import random
 import sys
 import sqlite3
 from typing import Callable, Type
+from entitydb.component import get_constructor_params, is_dirty, mark_clean
 from entitydb.entitydb import EntityDB, PRIMARY_KEY, ENTITY_REFERENCE, ENTITY_TABLE
 from entitydb.entity import Entity
 from entitydb.system import SystemWrapper, SystemCommands
@@ -40,6 +41,7 @@ class EntityDB_SQLite(EntityDB):
             cur.execute(f"INSERT INTO {component_name} ({','.join(columns)}) VALUES ({get_questionmarks(len(columns))})", [
                         component._uid] + [entity.uid] + list(EntityDB.get_variables_of(component).values()))
             con.commit()
+            mark_clean(component)
 
         # * Add the entity
 
@@ -55,7 +57,8 @@ class EntityDB_SQLite(EntityDB):
 
     def update_entity(self, entity: Entity) -> bool:
         con, cur = self._connect_to_db()
-        for component in entity.get_components():
+        changed_components = [component for component in entity.get_components() if is_dirty(component)]
+        for component in changed_components:
             component_name = type(component).__name__
             component_variables = EntityDB.get_variables_of(component)
             cvar_update_strings = []
@@ -65,6 +68,8 @@ class EntityDB_SQLite(EntityDB):
             cur.execute(statement, list(component_variables.values()))
         con.commit()
         con.close()
+        for component in changed_components:
+            mark_clean(component)
         return True
 
     def run(self, system_func: Callable) -> None:
@@ -178,7 +183,7 @@ class EntityDB_SQLite(EntityDB):
         con, cur = self._connect_to_db()
         cur.execute(
             f"CREATE TABLE IF NOT EXISTS {component_name} ({PRIMARY_KEY} INTEGER PRIMARY KEY, {ENTITY_REFERENCE} INTEGER)")
-        variables = EntityDB.get_instance_variables(component)
+        variables = get_constructor_params(component)
         for var_name in variables:
             if not does_column_exist(cur, component_name, var_name):
                 cur.execute(f"ALTER TABLE {component_name} ADD {var_name}")
@@ -21,6 +21,9 @@ def serialize(value: object) -> tuple[any, str]:
 def deserialize(value: bytes, out_type: type) -> object:
 
     if out_type is str:
+        # Some backends hand strings back already decoded
+        if isinstance(value, str):
+            return value
         return value.decode()
 
     elif out_type is bytes:
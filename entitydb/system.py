@@ -2,6 +2,7 @@ from enum import Enum
 import dataclasses
 import inspect
 from typing import Callable
+from entitydb.component import Component
 from entitydb.entity import Entity
 
 import entitydb
@@ -45,7 +46,8 @@ class SystemWrapper():
                 if arg == "return":
                     continue
 
-                elif dataclasses.is_dataclass(annotations[arg]):
+                elif dataclasses.is_dataclass(annotations[arg]) or (
+                        isinstance(annotations[arg], type) and issubclass(annotations[arg], Component)):
                     if arg.startswith("opt_"):
                         optional_components[arg] = annotations[arg]
                     else:
@@ -82,6 +84,12 @@ class SystemWrapper():
         self.edb_input = edb_input
         self.index_input = index_input
 
+        self.include_names: tuple[str, ...] = ()
+        self.exclude_names: tuple[str, ...] = ()
+        '''Names of the included and excluded components, for backends that set them in EntityDB._setup_system'''
+        self.matcher: Callable = None
+        '''Backend specific query for this system, set up by EntityDB._setup_system'''
+
     def run(self, entity: Entity, index: int) -> list[SystemCommands]:
         '''
         Runs the system using fields from the object. Assumes that the entity has
@@ -53,3 +53,7 @@ def increment_system(my_component: MyComponent):
 # Example for seeing how many entities match a systems signature
 num_matches = db.count_matches(increment_system)
 print(f"'increment_system' matches {num_matches} entities")
+
+
+# Wait for any saves still being written in the background (only with cache_components=True)
+db.flush()
@@ -0,0 +1,122 @@
+import fnmatch
+import itertools
+import threading
+
+import pytest
+
+
+class FakeBlob():
+    '''Just enough of google.cloud.storage.Blob for EntityDB_GCS'''
+
+    def __init__(self, bucket: 'FakeBucket', name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.content_type = None
+
+    def upload_from_string(self, data, content_type=None, **kwargs) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+        with self.bucket.lock:
+            self.generation = next(self.bucket.generations)
+            self.bucket.objects[self.name] = (self.generation, bytes(data))
+
+    def download_as_bytes(self, if_generation_not_match=None, **kwargs) -> bytes:
+        import google.api_core.exceptions as google_exceptions
+        with self.bucket.lock:
+            if self.name not in self.bucket.objects:
+                raise google_exceptions.NotFound(self.name)
+            generation, data = self.bucket.objects[self.name]
+        if generation == if_generation_not_match:
+            raise google_exceptions.NotModified(self.name)
+        self.generation = generation
+        self.bucket.downloads += 1
+        return data
+
+    def delete(self, **kwargs) -> None:
+        import google.api_core.exceptions as google_exceptions
+        with self.bucket.lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise google_exceptions.NotFound(self.name)
+
+
+class FakeBucket():
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.objects: dict[str, tuple[int, bytes]] = {}
+        self.generations = itertools.count(1)
+        self.lock = threading.Lock()
+        self.listings = 0
+        '''How many times the bucket has been listed'''
+        self.downloads = 0
+        '''How many blob bodies have been sent back'''
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+class FakeClient():
+    '''In-memory stand-in for google.cloud.storage.Client'''
+    SCOPE = ()
+    buckets: dict[str, FakeBucket] = {}
+
+    def __init__(self, project=None, _http=None, **kwargs) -> None:
+        self.project = project
+        self._http = _http
+
+    def get_bucket(self, name: str) -> FakeBucket:
+        import google.api_core.exceptions as google_exceptions
+        if name not in self.buckets:
+            raise google_exceptions.NotFound(name)
+        return self.buckets[name]
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(name)
+
+    def create_bucket(self, bucket: FakeBucket, location=None) -> FakeBucket:
+        self.buckets[bucket.name] = bucket
+        return bucket
+
+    def list_blobs(self, bucket: FakeBucket, prefix="", delimiter=None, match_glob=None, **kwargs):
+        with bucket.lock:
+            bucket.listings += 1
+            names = sorted(bucket.objects)
+        for name in names:
+            rest = name[len(prefix):]
+            if not name.startswith(prefix) or (delimiter and delimiter in rest):
+                continue
+            # Like GCS, "*" doesn't match across "/"
+            if match_glob and not any(fnmatch.fnmatchcase(name, glob) and name.count("/") == glob.count("/")
+                                      for glob in expand_braces(match_glob)):
+                continue
+            yield bucket.blob(name)
+
+
+def expand_braces(glob: str) -> list[str]:
+    if "{" not in glob:
+        return [glob]
+    start, rest = glob.split("{", 1)
+    options, end = rest.split("}", 1)
+    return [start + option + end for option in options.split(",")]
+
+
+@pytest.fixture
+def make_gcs_db(monkeypatch):
+    '''
+    Makes EntityDB_GCS instances backed by an in-memory bucket.
+    Every instance made in one test shares the same bucket, like separate clients would.
+    '''
+    pytest.importorskip("google.cloud.storage")
+    pytest.importorskip("msgpack")
+    pytest.importorskip("numpy")
+    import google.auth
+    from entitydb import entitydb_gcs
+
+    monkeypatch.setattr(entitydb_gcs.storage, "Client", FakeClient)
+    monkeypatch.setattr(google.auth, "default", lambda *args, **kwargs: (None, "test-project"))
+    monkeypatch.setattr(FakeClient, "buckets", {})
+
+    def make(**kwargs) -> 'entitydb_gcs.EntityDB_GCS':
+        return entitydb_gcs.EntityDB_GCS("test-bucket", **kwargs)
+
+    return make
@@ -0,0 +1,131 @@
+import dataclasses
+
+import pytest
+
+from entitydb import Component, component
+from entitydb.component import COMPONENT_REGISTRY, get_constructor_params, is_dirty, mark_clean, mark_dirty
+
+
+@component
+class Health:
+    hp: int
+    name: str
+
+
+@component
+class Inventory:
+    items: list
+
+
+@component(frozen=True)
+class FrozenPoint:
+    x: int
+
+
+@component(slots=True)
+class SlotPoint:
+    x: int
+
+
+def test_component_is_a_registered_dataclass():
+    assert dataclasses.is_dataclass(Health)
+    assert COMPONENT_REGISTRY["Health"] is Health
+    assert COMPONENT_REGISTRY["FrozenPoint"] is FrozenPoint
+    assert Health(1, "a") == Health(1, "a")
+
+
+def test_component_subclasses_are_registered():
+    @dataclasses.dataclass
+    class Speed(Component):
+        value: float
+
+    assert COMPONENT_REGISTRY["Speed"] is Speed
+
+
+def test_get_constructor_params():
+    @component
+    class Armour(Health):
+        weight: float
+
+    assert get_constructor_params(Health) == {"hp": int, "name": str}
+    assert get_constructor_params(Armour) == {"hp": int, "name": str, "weight": float}
+    # A subclass never uses the params worked out for its parent
+    assert get_constructor_params(Health) == {"hp": int, "name": str}
+
+
+def test_constructor_params_need_types():
+    with pytest.raises(TypeError):
+        class Label(Component):
+            def __init__(self, label):
+                self.label = label
+    assert "Label" not in COMPONENT_REGISTRY
+
+    class Typed(Component):
+        def __init__(self, label: str, *args, **kwargs):
+            self.label = label
+
+    assert get_constructor_params(Typed) == {"label": str}
+
+    class Plain:
+        def __init__(self, value):
+            self.value = value
+
+    with pytest.raises(TypeError):
+        get_constructor_params(Plain)
+
+
+def test_new_components_are_dirty():
+    assert is_dirty(Health(1, "a"))
+
+
+def test_mark_clean_then_set():
+    health = Health(1, "a")
+    mark_clean(health)
+    assert not is_dirty(health)
+    health.hp = 2
+    assert is_dirty(health)
+    mark_clean(health)
+    mark_dirty(health)
+    assert is_dirty(health)
+
+
+def test_private_variables_dont_make_dirty():
+    health = Health(1, "a")
+    mark_clean(health)
+    health._uid = "cid"
+    assert not is_dirty(health)
+
+
+def test_mutable_values_are_always_dirty():
+    inventory = Inventory([])
+    mark_clean(inventory)
+    assert is_dirty(inventory)
+
+
+def test_untracked_components_are_always_dirty():
+    for point in [FrozenPoint(1), SlotPoint(1)]:
+        mark_clean(point)
+        assert is_dirty(point)
+
+
+
+def test_slotted_components_have_a_uid_slot():
+    point = SlotPoint(1)
+    assert not hasattr(point, "__dict__")
+    assert point._uid is None
+    point._uid = "abc"
+    assert point == SlotPoint(1)
+    assert repr(point) == "SlotPoint(x=1)"
+    assert get_constructor_params(SlotPoint) == {"x": int}
+
+def test_component_subclass_tracks_changes():
+    @dataclasses.dataclass
+    class Speed(Component):
+        value: float
+
+    assert get_constructor_params(Speed) == {"value": float}
+    speed = Speed(1.0)
+    mark_clean(speed)
+    assert not is_dirty(speed)
+    speed.value = 2.0
+    assert is_dirty(speed)
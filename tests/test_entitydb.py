@@ -0,0 +1,47 @@
+from entitydb import EntityDB, component
+
+
+@component
+class Mana:
+    hp: int
+    name: str = "nobody"
+
+
+class Plain():
+    def __init__(self, x: int) -> None:
+        self.x = x
+        self._hidden = 1
+
+
+class Slotted():
+    __slots__ = ("x", "_uid")
+
+    def __init__(self, x: int) -> None:
+        self.x = x
+
+
+class SlottedChild(Slotted):
+    __slots__ = "y"
+
+    def __init__(self, x: int, y: int) -> None:
+        super().__init__(x)
+        self.y = y
+
+
+def test_get_variables_of():
+    assert EntityDB.get_variables_of(Plain(1)) == {"x": 1}
+
+
+def test_get_variables_of_slots():
+    assert EntityDB.get_variables_of(Slotted(1)) == {"x": 1}
+    assert EntityDB.get_variables_of(SlottedChild(1, 2)) == {"y": 2, "x": 1}
+
+
+def test_create_component_from_data():
+    mana = EntityDB()._create_component_from_data(Mana, {"hp": b"3", "name": b"a", "old": b"x"}, "cid")
+    assert (mana.hp, mana.name, mana._uid) == (3, "a", "cid")
+
+
+def test_create_component_from_data_uses_defaults():
+    mana = EntityDB()._create_component_from_data(Mana, {"hp": b"3"}, "cid")
+    assert (mana.hp, mana.name) == (3, "nobody")
@@ -0,0 +1,734 @@
+import concurrent.futures
+import dataclasses
+import gc
+import threading
+import weakref
+
+import pytest
+
+from entitydb import Component, Entity, SystemCommands, component
+
+np = pytest.importorskip("numpy")
+msgpack = pytest.importorskip("msgpack")
+pytest.importorskip("google.cloud.storage")
+
+from entitydb.component import is_dirty
+from entitydb.entitydb_gcs import (
+    DATA_FOLDER, HTTP_RETRIES, PREFETCH_DEPTH, UID_LENGTH, bitset_indices, clear_bit, set_bit)
+
+
+@component
+class Position:
+    x: int
+
+
+@component
+class Name:
+    name: str
+
+
+@component
+class Tag:
+    pass
+
+
+@dataclasses.dataclass
+class Velocity(Component):
+    dx: int
+    label: str
+
+
+@component
+class Stats:
+    hp: int
+    title: str
+    raw: bytes
+    tags: list
+    extra: dict
+    pair: tuple
+
+
+@component(slots=True)
+class Coords:
+    x: int
+    y: int
+
+
+def stored_x(db, component: object) -> int:
+    body = db.bucket.objects[f"{DATA_FOLDER}/{component._uid}"][1]
+    return int(msgpack.unpackb(body, raw=False)["x"])
+
+
+def collect(db) -> list[int]:
+    '''Runs a system over every Position, returns their x values sorted'''
+    found: list[int] = []
+
+    def read(position: Position):
+        found.append(position.x)
+
+    db.run(read)
+    return sorted(found)
+
+
+def test_add_entity_round_trip(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1), Name("a")]))
+    db.add_entity(Entity([Position(2)]))
+    found = []
+
+    def read(position: Position, name: Name):
+        found.append((position.x, name.name))
+
+    # A new client only has what was uploaded to go on
+    make_gcs_db().run(read)
+    assert found == [(1, "a")]
+    assert collect(make_gcs_db()) == [1, 2]
+
+
+def test_each_component_is_one_blob(make_gcs_db):
+    db = make_gcs_db()
+    stats = Stats(10, "knight", b"\x00\x01", ["a", 1], {"k": [1.5]}, (1, 2))
+    db.add_entity(Entity([stats, Position(1)]))
+    assert len([name for name in db.bucket.objects if name.startswith(f"{DATA_FOLDER}/")]) == 2
+    body = db.bucket.objects[f"{DATA_FOLDER}/{stats._uid}"][1]
+    assert sorted(msgpack.unpackb(body, raw=False)) == ["extra", "hp", "pair", "raw", "tags", "title"]
+
+    found = []
+
+    def read(loaded: Stats):
+        found.append(loaded)
+
+    make_gcs_db().run(read)
+    assert [(s.hp, s.title, s.raw, s.tags, s.extra, s.pair) for s in found] == \
+        [(10, "knight", b"\x00\x01", ["a", 1], {"k": [1.5]}, (1, 2))]
+
+
+def test_saved_changes_are_stored(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+
+    def move(position: Position):
+        position.x += 1
+        return SystemCommands.SAVE_ENTITY
+
+    db.run(move)
+    db.flush()
+    assert collect(make_gcs_db()) == [2]
+
+
+def test_nothing_is_uploaded_if_a_field_cant_be_serialized(make_gcs_db):
+    db = make_gcs_db()
+    with pytest.raises(Exception):
+        db.add_entity(Entity([Name("a"), Position(lambda: 0)]))
+    assert db.bucket.objects == {}
+
+
+def test_failed_upload_is_raised(make_gcs_db):
+    db = make_gcs_db()
+
+    def failing_upload(name):
+        raise RuntimeError("upload failed")
+
+    db._create_empty_blob = failing_upload
+    with pytest.raises(RuntimeError):
+        db.add_entity(Entity([Position(1)]))
+
+
+def test_entities_missing_a_component_dont_match(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+    found = []
+
+    # Nothing has a Name, so the first listing is already empty
+    def read(name: Name, position: Position):
+        found.append(name)
+
+    db.run(read)
+    assert found == []
+
+
+def test_delete_entity_removes_its_blobs(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1), Name("a")]))
+
+    def delete(position: Position):
+        return SystemCommands.DELETE_ENTITY
+
+    db.run(delete)
+    assert db.bucket.objects == {}
+    assert collect(make_gcs_db()) == []
+
+
+def test_load_component(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1), Name("a")]))
+    found = []
+
+    def read(entity: Entity, position: Position):
+        found.append(entity)
+
+    make_gcs_db().run(read)
+    entity = found[0]
+    assert Name not in entity._components
+    assert make_gcs_db().load_component(entity, Name)
+    assert entity._components[Name].name == "a"
+    assert not make_gcs_db().load_component(entity, Stats)
+
+
+def test_listings_are_reused(make_gcs_db):
+    db = make_gcs_db(index_ttl=60)
+    db.add_entity(Entity([Position(1)]))
+    assert collect(db) == [1]
+    listings = db.bucket.listings
+
+    # Our own changes are added to the cached listing
+    db.add_entity(Entity([Position(2)]))
+    assert collect(db) == [1, 2]
+    assert db.bucket.listings == listings
+
+    # Others' changes aren't seen until the listing is too old
+    make_gcs_db().add_entity(Entity([Position(3)]))
+    assert collect(db) == [1, 2]
+
+
+def test_entities_deleted_by_others_are_skipped(make_gcs_db):
+    db = make_gcs_db(index_ttl=60)
+    db.add_entity(Entity([Position(1)]))
+    db.add_entity(Entity([Position(2)]))
+    assert collect(db) == [1, 2]
+
+    def delete_first(position: Position):
+        if position.x == 1:
+            return SystemCommands.DELETE_ENTITY
+
+    make_gcs_db().run(delete_first)
+    # Still in the cached listing, but its data is gone
+    assert collect(db) == [2]
+    assert "Position" in db._dirty_components
+    listings = db.bucket.listings
+    assert collect(db) == [2]
+    assert db.bucket.listings == listings + 1
+
+
+def test_old_listings_are_listed_again(make_gcs_db):
+    db = make_gcs_db(index_ttl=-1)
+    assert collect(db) == []
+    make_gcs_db().add_entity(Entity([Position(3)]))
+    assert collect(db) == [3]
+
+
+def test_bitset_helpers():
+    bitset = np.zeros(4, dtype=np.uint64)
+    for ix in [0, 5, 63, 64, 127, 200, 255]:
+        set_bit(bitset, ix)
+    clear_bit(bitset, 5)
+    assert list(bitset_indices(bitset)) == [0, 63, 64, 127, 200, 255]
+
+
+def test_bitsets_grow_past_64_entities(make_gcs_db):
+    db = make_gcs_db()
+    # List Position while it is empty, so the bitsets have to grow as entities are added
+    assert collect(db) == []
+    for i in range(150):
+        db.add_entity(Entity([Position(i)] + ([Name(str(i))] if i % 3 == 0 else [])))
+
+    assert db._bitset_words * 64 >= 150
+    both: list[int] = []
+    no_name: list[int] = []
+
+    def read_both(position: Position, name: Name):
+        both.append(position.x)
+
+    def read_no_name(position: Position, exclude=[Name]):
+        no_name.append(position.x)
+
+    db.run(read_both)
+    db.run(read_no_name)
+    assert sorted(both) == list(range(0, 150, 3))
+    assert sorted(no_name) == [i for i in range(150) if i % 3]
+    assert collect(db) == list(range(150))
+
+    # A new client lists everything up front and agrees
+    both.clear()
+    make_gcs_db().run(read_both)
+    assert sorted(both) == list(range(0, 150, 3))
+
+
+def test_delete_clears_bits(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+    db.add_entity(Entity([Position(2)]))
+    assert collect(db) == [1, 2]
+
+    def delete_first(position: Position):
+        if position.x == 1:
+            return SystemCommands.DELETE_ENTITY
+
+    db.run(delete_first)
+    assert collect(db) == [2]
+    assert collect(make_gcs_db()) == [2]
+
+
+def delete_all(position: Position):
+    return SystemCommands.DELETE_ENTITY
+
+
+def test_deleted_entities_free_their_bits(make_gcs_db):
+    db = make_gcs_db()
+    assert collect(db) == []
+    for i in range(200):
+        db.add_entity(Entity([Position(i)]))
+        db.run(delete_all)
+    assert db._bitset_words == 1
+    db.add_entity(Entity([Position(7)]))
+    assert collect(db) == [7]
+
+
+def test_entities_deleted_by_others_free_their_bits_when_listed_again(make_gcs_db):
+    db = make_gcs_db(index_ttl=-1)
+    other = make_gcs_db()
+    for i in range(200):
+        other.add_entity(Entity([Position(i)]))
+        assert collect(db) == [i]
+        other.run(delete_all)
+    assert db._bitset_words == 1
+
+
+def test_prefetched_entities_all_load(make_gcs_db):
+    db = make_gcs_db()
+    for i in range(PREFETCH_DEPTH * 3):
+        db.add_entity(Entity([Position(i), Name(str(i))]))
+    found = []
+
+    def read(position: Position, name: Name):
+        found.append((position.x, name.name))
+
+    make_gcs_db().run(read)
+    assert sorted(found) == [(i, str(i)) for i in range(PREFETCH_DEPTH * 3)]
+
+
+def test_break_cancels_prefetched_downloads(make_gcs_db):
+    for i in range(PREFETCH_DEPTH * 3):
+        make_gcs_db().add_entity(Entity([Position(i)]))
+    db = make_gcs_db()
+
+    # One worker, and every download after the first waits, so the rest stay queued
+    db._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    downloads = []
+    download = db._download_component_blob
+
+    def gated_download(cid):
+        downloads.append(cid)
+        if len(downloads) > 1:
+            release.wait(5)
+        return download(cid)
+
+    db._download_component_blob = gated_download
+
+    def first_only(position: Position):
+        return SystemCommands.BREAK
+
+    db.run(first_only)
+    release.set()
+    db._io_pool.shutdown(wait=True)
+    # Only the first download, and maybe the one already running when the system stopped
+    assert len(downloads) <= 2
+
+
+def test_random_ids(make_gcs_db):
+    db = make_gcs_db()
+    eids = {db._random_eid() for i in range(100)}
+    cids = {db._random_cid() for i in range(100)}
+    assert len(eids) == len(cids) == 100
+    for uid in eids | cids:
+        assert len(uid) == UID_LENGTH
+        assert "-" not in uid and "/" not in uid
+    assert all(eid[0].isdigit() for eid in eids)
+    assert all(cid[0].isalpha() for cid in cids)
+
+
+def test_systems_are_parsed_once(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+    setups = []
+    setup_system = db._setup_system
+    db._setup_system = lambda system: setups.append(system) or setup_system(system)
+
+    def read(position: Position):
+        pass
+
+    db.run(read)
+    db.run(read)
+    assert db.count_matches(read) == 1
+    assert len(setups) == 1
+
+
+def test_query_names_are_worked_out_at_setup(make_gcs_db):
+    db = make_gcs_db()
+
+    def read(position: Position, name: Name, exclude=[Tag]):
+        pass
+
+    system = db._parse_system(read)
+    assert system.include_names == ("Position", "Name")
+    assert system.exclude_names == ("Tag",)
+    # Both the matcher and the pre-check use the stored names
+    system.include_components = {}
+    system.exclude_components = []
+    db.add_entity(Entity([Position(1), Name("a")]))
+    db.add_entity(Entity([Position(2), Name("b"), Tag()]))
+    assert len(db._match_entities(system)) == 1
+
+
+def test_count_matches(make_gcs_db):
+    db = make_gcs_db()
+    for i in range(10):
+        db.add_entity(Entity([Position(i)] + ([Name(str(i))] if i % 2 else [])))
+
+    def both(position: Position, name: Name):
+        pass
+
+    def no_name(position: Position, exclude=[Name]):
+        pass
+
+    def no_components(entity: Entity):
+        pass
+
+    assert db.count_matches(both) == 5
+    assert db.count_matches(no_name) == 5
+    assert db.count_matches(no_components) == 0
+
+
+def test_query_is_listed_in_one_request(make_gcs_db):
+    from entitydb import entitydb_gcs
+    if not entitydb_gcs.LIST_SUPPORTS_MATCH_GLOB:
+        pytest.skip("google-cloud-storage is too old for match_glob")
+    make_gcs_db().add_entity(Entity([Position(1), Name("a")]))
+    db = make_gcs_db()
+    listings = db.bucket.listings
+    calls = []
+    list_blobs = db.storage_client.list_blobs
+    db.storage_client.list_blobs = lambda bucket, **kwargs: calls.append(kwargs) or list_blobs(bucket, **kwargs)
+
+    def read(position: Position, name: Name, exclude=[Stats]):
+        pass
+
+    assert db.count_matches(read) == 1
+    assert db.bucket.listings == listings + 1
+    # Only the component folder is scanned
+    assert calls[0]["prefix"] == "cmp/"
+
+
+def test_query_is_listed_without_match_glob(make_gcs_db, monkeypatch):
+    from entitydb import entitydb_gcs
+    monkeypatch.setattr(entitydb_gcs, "LIST_SUPPORTS_MATCH_GLOB", False)
+    make_gcs_db().add_entity(Entity([Position(1), Name("a")]))
+    make_gcs_db().add_entity(Entity([Position(2)]))
+    db = make_gcs_db()
+    listings = db.bucket.listings
+
+    def read(position: Position, name: Name, exclude=[Stats]):
+        pass
+
+    assert db.count_matches(read) == 1
+    # One listing per component folder
+    assert db.bucket.listings == listings + 3
+
+
+def test_write_behind_keeps_order_per_component(make_gcs_db):
+    db = make_gcs_db(cache_components=True)
+    position = Position(0)
+    entity = Entity([position])
+    db.add_entity(entity)
+
+    # Hold the first upload until every save is queued
+    release = threading.Event()
+    upload = db._upload_component_blob
+
+    def slow_upload(cid, body):
+        release.wait(5)
+        upload(cid, body)
+
+    db._upload_component_blob = slow_upload
+    for x in [1, 2, 3]:
+        position.x = x
+        db.update_entity(entity)
+    release.set()
+    db.flush()
+
+    assert stored_x(db, position) == 3
+    assert db._pending_writes == {}
+
+
+def test_failed_write_behind_is_raised_and_evicted(make_gcs_db):
+    db = make_gcs_db(cache_components=True)
+    position = Position(1)
+    entity = Entity([position])
+    db.add_entity(entity)
+    upload = db._upload_component_blob
+
+    def failing_upload(cid, body):
+        raise RuntimeError("upload failed")
+
+    db._upload_component_blob = failing_upload
+    position.x = 2
+    db.update_entity(entity)
+    with pytest.raises(RuntimeError):
+        db.flush()
+    db.flush()
+
+    # Storage never got it, so it must not be served from the cache, and must be saved again
+    assert entity.uid not in db._components_by_type[Position]
+    assert is_dirty(position)
+    assert collect(db) == [1]
+
+    db._upload_component_blob = upload
+    db.update_entity(entity)
+    db.flush()
+    assert stored_x(db, position) == 2
+
+
+def test_cached_components_skip_downloads(make_gcs_db):
+    db = make_gcs_db(cache_components=True)
+    db.add_entity(Entity([Position(1), Name("a")]))
+    downloads = []
+    download = db._download_component_blob
+    db._download_component_blob = lambda cid: downloads.append(cid) or download(cid)
+
+    assert collect(db) == [1]
+    assert downloads == []
+
+
+def test_stray_blobs_in_component_folders_are_skipped(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1), Name("a")]))
+    db.bucket.blob("cmp/Position/notes.txt").upload_from_string("")
+    db.bucket.blob("cmp/Name/a-b-c").upload_from_string("")
+
+    def read(position: Position, name: Name):
+        pass
+
+    assert make_gcs_db().count_matches(read) == 1
+
+
+def test_http_pool(make_gcs_db):
+    db = make_gcs_db(http_pool_size=8)
+    adapter = db.storage_client._http.get_adapter("https://storage.googleapis.com")
+    assert adapter._pool_maxsize == 8
+    assert adapter.max_retries.total == HTTP_RETRIES
+
+
+def test_stale_components_arent_listed_if_nothing_can_match(make_gcs_db):
+    make_gcs_db().add_entity(Entity([Name("a")]))
+    db = make_gcs_db(index_ttl=60)
+    assert collect(db) == []
+    listings = db.bucket.listings
+
+    # No entity has a Position, so Name is never listed
+    def read(position: Position, name: Name):
+        pass
+
+    assert db.count_matches(read) == 0
+    assert db.bucket.listings == listings
+    assert "Name" not in db._component_index
+
+
+def test_packers_are_reused_per_thread(make_gcs_db):
+    db = make_gcs_db()
+    packer = db._get_packer()
+    assert db._get_packer() is packer
+    assert db._io_pool.submit(db._get_packer).result() is not packer
+    assert msgpack.unpackb(db._pack_component(Position(5)), raw=False) == {"x": "5"}
+
+
+def test_unchanged_components_are_not_saved(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+    uploads = []
+    upload = db._upload_component_blob
+    db._upload_component_blob = lambda cid, body: uploads.append(cid) or upload(cid, body)
+
+    def save(position: Position):
+        return SystemCommands.SAVE_ENTITY
+
+    db.run(save)
+    db.flush()
+    assert uploads == []
+
+    def move(position: Position):
+        position.x += 1
+        return SystemCommands.SAVE_ENTITY
+
+    db.run(move)
+    db.flush()
+    assert len(uploads) == 1
+    assert collect(make_gcs_db()) == [2]
+
+
+def test_field_less_components_have_no_data_blob(make_gcs_db):
+    db = make_gcs_db()
+    tag = Tag()
+    db.add_entity(Entity([tag, Position(1)]))
+    assert f"{DATA_FOLDER}/{tag._uid}" not in db.bucket.objects
+
+    other = make_gcs_db()
+    downloads = []
+    download = other._download_component_blob
+    other._download_component_blob = lambda cid: downloads.append(cid) or download(cid)
+    found = []
+
+    def read(tag: Tag, position: Position):
+        found.append((tag, position.x))
+        return SystemCommands.DELETE_ENTITY
+
+    other.run(read)
+    assert [(type(tag), x) for tag, x in found] == [(Tag, 1)]
+    assert len(downloads) == 1
+    assert db.bucket.objects == {}
+
+
+def test_unchanged_blobs_arent_sent_again(make_gcs_db):
+    writer = make_gcs_db()
+    position = Position(1)
+    entity = Entity([position])
+    writer.add_entity(entity)
+    db = make_gcs_db(cache_components=False, index_ttl=60)
+
+    assert collect(db) == [1]
+    downloads = db.bucket.downloads
+    assert collect(db) == [1]
+    # Asked again, but only if it changed, which it hadn't
+    assert db.bucket.downloads == downloads
+
+    position.x = 2
+    writer.update_entity(entity)
+    writer.flush()
+    assert collect(db) == [2]
+    assert db.bucket.downloads == downloads + 1
+
+
+def test_blob_cache_drops_least_recently_used(make_gcs_db, monkeypatch):
+    from entitydb import entitydb_gcs
+    monkeypatch.setattr(entitydb_gcs, "BLOB_CACHE_SIZE", 2)
+    writer = make_gcs_db()
+    positions = [Position(i) for i in range(3)]
+    for position in positions:
+        writer.add_entity(Entity([position]))
+    db = make_gcs_db(cache_components=False)
+
+    for position in positions:
+        db._download_component_blob(position._uid)
+    db._download_component_blob(positions[1]._uid)
+    assert list(db._blob_cache) == [f"{DATA_FOLDER}/{positions[i]._uid}" for i in (2, 1)]
+
+
+def test_throwaway_systems_are_freed(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+    found = []
+
+    def make_system(offset: int):
+        def read(position: Position):
+            found.append(position.x + offset)
+        return read
+
+    system = make_system(10)
+    db.run(system)
+    db.run(system)
+    throwaway = lambda: None
+    db.run(throwaway)
+    assert len(db._system_cache) == 2
+
+    refs = [weakref.ref(system), weakref.ref(throwaway)]
+    del system, throwaway
+    gc.collect()
+    assert [ref() for ref in refs] == [None, None]
+    assert len(db._system_cache) == 0
+    assert found == [11, 11]
+
+
+def test_component_cache_is_off_by_default(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Position(1)]))
+
+    def change_without_saving(position: Position):
+        position.x += 100
+
+    db.run(change_without_saving)
+    assert collect(db) == [1]
+
+
+def test_failed_write_behind_is_raised_by_next_update(make_gcs_db):
+    db = make_gcs_db(cache_components=True)
+    first = Entity([Position(1)])
+    second = Entity([Position(2)])
+    db.add_entity(first)
+    db.add_entity(second)
+    upload = db._upload_component_blob
+
+    def failing_upload(cid, body):
+        raise RuntimeError("upload failed")
+
+    db._upload_component_blob = failing_upload
+    first.get(Position).x = 10
+    db.update_entity(first)
+    for future in list(db._pending_writes.values()):
+        future.exception()
+
+    db._upload_component_blob = upload
+    second.get(Position).x = 20
+    with pytest.raises(RuntimeError):
+        db.update_entity(second)
+
+    # Nothing was saved, so retrying saves the change
+    db.update_entity(second)
+    db.flush()
+    assert stored_x(db, second.get(Position)) == 20
+
+
+def test_component_subclass_round_trip(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Velocity(3, "fast")]))
+    found = []
+
+    def read(velocity: Velocity):
+        found.append((velocity.dx, velocity.label))
+
+    make_gcs_db().run(read)
+    assert found == [(3, "fast")]
+
+
+class Score(Component):
+    def __init__(self, points: int) -> None:
+        self.points = points
+
+
+def test_plain_component_subclass_in_signature(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Score(7), Position(1)]))
+    found = []
+
+    def read(score: Score, position: Position):
+        found.append((score.points, position.x))
+
+    make_gcs_db().run(read)
+    assert found == [(7, 1)]
+
+
+def test_slotted_component_round_trip(make_gcs_db):
+    db = make_gcs_db()
+    db.add_entity(Entity([Coords(1, 2), Position(3)]))
+
+    def move(coords: Coords):
+        coords.y += 10
+        return SystemCommands.SAVE_ENTITY
+
+    db.run(move)
+    found: list[tuple[int, int]] = []
+
+    def read(coords: Coords, position: Position):
+        found.append((coords.x, coords.y, position.x))
+
+    make_gcs_db().run(read)
+    assert found == [(1, 12, 3)]
@@ -0,0 +1,68 @@
+import pytest
+
+from entitydb import Entity, SystemCommands, component
+from entitydb.entitydb_sqlite import EntityDB_SQLite
+
+
+@component
+class Counter:
+    count: int
+    label: str
+
+
+@component(slots=True)
+class Level:
+    value: int
+
+
+@pytest.fixture
+def db(tmp_path):
+    return EntityDB_SQLite(str(tmp_path / "test.db"))
+
+
+def counts(db) -> list[int]:
+    found: list[int] = []
+
+    def read(counter: Counter):
+        found.append(counter.count)
+
+    db.run(read)
+    return sorted(found)
+
+
+def test_unchanged_components_are_not_saved(db):
+    db.add_entity(Entity([Counter(1, "a")]))
+    statements: list[str] = []
+    connect = db._connect_to_db
+
+    def traced_connect(*args, **kwargs):
+        con, cur = connect(*args, **kwargs)
+        con.set_trace_callback(statements.append)
+        return con, cur
+
+    db._connect_to_db = traced_connect
+
+    def save(counter: Counter):
+        return SystemCommands.SAVE_ENTITY
+
+    db.run(save)
+    assert not [statement for statement in statements if statement.startswith("UPDATE")]
+
+    def increment(counter: Counter):
+        counter.count += 1
+        return SystemCommands.SAVE_ENTITY
+
+    db.run(increment)
+    assert len([statement for statement in statements if statement.startswith("UPDATE")]) == 1
+    assert counts(db) == [2]
+
+
+def test_slotted_component_round_trip(db):
+    db.add_entity(Entity([Level(5), Counter(1, "a")]))
+    found: list[int] = []
+
+    def read(level: Level, counter: Counter):
+        found.append(level.value)
+
+    db.run(read)
+    assert found == [5]
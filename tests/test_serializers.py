@@ -0,0 +1,19 @@
+import math
+
+import pytest
+
+from entitydb.serializers import deserialize, serialize
+
+
+@pytest.mark.parametrize("value", [
+    "text", b"\x00\x01", 5, -2 ** 70, 1.5, True, None,
+    [1, "a", [2.5, None]], {"a": {"b": [1, 2]}, "c": False},
+    (1, 2), {1: "a"}, {"a": (1, 2)}, {1, 2}, [2 ** 70],
+])
+def test_round_trip(value):
+    assert deserialize(serialize(value)[0], type(value)) == value
+
+
+def test_nan_round_trips():
+    assert math.isnan(deserialize(serialize(float("nan"))[0], float))
+    assert deserialize(serialize([float("inf")])[0], list) == [float("inf")]